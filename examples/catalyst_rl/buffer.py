@@ -1,24 +1,102 @@
 # flake8: noqa
-from typing import Tuple
-import multiprocessing as mp
+from typing import Callable, Dict, Iterator, Tuple
+import ctypes
+import time
 
 from gym import spaces
 from misc import structed2dict
 import numpy as np
+import torch
+import torch.multiprocessing as mp
 from torch.utils.data.dataset import Dataset, IterableDataset
+from torch.utils.data.sampler import Sampler
 
+try:
+    from numba import njit
 
-def _handle_array(array: np.ndarray):
+    IS_NUMBA_AVAILABLE = True
+except ImportError:
+    IS_NUMBA_AVAILABLE = False
+
+
+def _to_tensor(array: np.ndarray, keep_bytes: bool = False) -> torch.Tensor:
+    tensor = torch.as_tensor(array)
+    # byte observations are casted to float on the training device
+    if not (keep_bytes and tensor.dtype == torch.uint8):
+        tensor = tensor.float()
+    return tensor
+
+
+def _handle_array(array: np.ndarray, keep_bytes: bool = False):
     array = structed2dict(array)
 
     if isinstance(array, dict):
-        output = dict((key, np.array(value).astype(np.float32)) for key, value in array.items())
+        # the structured array fields are strided views (torch rejects their strides),
+        # so they are copied into the packed arrays first
+        output = dict(
+            (key, _to_tensor(np.array(value, order="C"), keep_bytes))
+            for key, value in array.items()
+        )
     else:
-        output = np.array(array).astype(np.float32)
+        output = _to_tensor(array, keep_bytes)
 
     return output
 
 
+def _mask_frames(frames: torch.Tensor, num_frames: torch.Tensor) -> torch.Tensor:
+    history_len = frames.shape[1]
+    positions = torch.arange(history_len, device=frames.device)
+    # the frames before the episode start are masked out
+    mask = positions < (history_len - num_frames[:, None])
+    mask = mask.view(mask.shape + (1,) * (frames.dim() - 2))
+    return frames.masked_fill(mask, 0)
+
+
+def compose_states(batch: Dict, history_len: int) -> Dict:
+    """
+    Composes ``state`` and ``next_state`` from the batch ``frames``
+    (see ``OffpolicyReplayBuffer.sample_batch``), should be called
+    on the training device. Batches without ``frames`` are returned as is.
+    """
+    if "frames" not in batch:
+        return batch
+
+    frames = batch.pop("frames")
+    # the state takes the first frames, the next state takes the last ones
+    for key, window in (("state", slice(history_len)), ("next_state", slice(-history_len, None))):
+        num_frames = batch.pop(f"{key}_len")
+        if isinstance(frames, dict):
+            batch[key] = {
+                name: _mask_frames(value[:, window], num_frames) for name, value in frames.items()
+            }
+        else:
+            batch[key] = _mask_frames(frames[:, window], num_frames)
+
+    return batch
+
+
+def _get_shared_array(shape: Tuple, dtype, storage: torch.Tensor = None) -> np.ndarray:
+    """Allocates (or wraps) the numpy array on top of the torch shared memory storage"""
+    dtype = np.dtype(dtype)
+    if storage is None:
+        storage = torch.empty(int(np.prod(shape)) * dtype.itemsize, dtype=torch.uint8)
+        storage.share_memory_()
+    return storage.numpy().view(dtype).reshape(shape)
+
+
+def _get_shared_storage(array: np.ndarray) -> torch.Tensor:
+    """Finds the torch shared memory storage under the ``_get_shared_array`` output"""
+    storage = array
+    while not isinstance(storage, torch.Tensor):
+        storage = storage.base
+    return storage
+
+
+def _get_counter(is_shared: bool):
+    """Integer counter, in the shared memory if the storage is shared between processes"""
+    return mp.RawValue("l", 0) if is_shared else ctypes.c_long(0)
+
+
 def get_buffer(
     capacity: int,
     space: spaces.Space = None,
@@ -28,7 +106,7 @@ def get_buffer(
     name: str = None,
     logdir: str = None,
 ):
-    assert mode in ["numpy", "memmap", "dynamic"]
+    assert mode in ["numpy", "memmap", "shared", "dynamic"]
     assert (space is None and shape is not None and dtype is not None) or (
         space is not None and shape is None and dtype is None
     )
@@ -73,6 +151,21 @@ def get_buffer(
             buffer = np.memmap(
                 f"{logdir}/{name}.memmap", mode="w+", shape=(capacity,), dtype=buffer_dtype
             )
+    elif mode == "shared":
+        if space is None or not isinstance(space, spaces.Dict):
+            space_shape = shape if space is None else space.shape
+            space_dtype = dtype if space is None else space.dtype
+
+            buffer_dtype = space_dtype
+            buffer = _get_shared_array((capacity,) + tuple(space_shape), dtype=space_dtype)
+        else:
+            assert space is not None
+
+            buffer_dtype = []
+            for key, value in space.spaces.items():
+                buffer_dtype.append((key, value.dtype, value.shape))
+            buffer_dtype = np.dtype(buffer_dtype)
+            buffer = _get_shared_array((capacity,), dtype=buffer_dtype)
     elif mode == "dynamic":
         raise NotImplementedError()
     else:
@@ -81,6 +174,48 @@ def get_buffer(
     return buffer, buffer_dtype
 
 
+if IS_NUMBA_AVAILABLE:
+
+    @njit(
+        "void(f4[::1], b1[::1], i8[::1], i8[::1], i8, i8, i8, f4[::1], "
+        "i8[::1], i8[::1], f4[::1], b1[::1])",
+        cache=True,
+        fastmath=True,
+    )
+    def _build_batch(
+        rewards,
+        dones,
+        episode_steps,
+        indices,
+        length,
+        history_len,
+        n_step,
+        gamma_pow,
+        out_state_len,
+        out_next_state_len,
+        out_reward,
+        out_done,
+    ):
+        # serial on purpose: the threading layers do not survive the forked DataLoader
+        # workers, the parallelism comes from the workers themselves
+        for b in range(indices.size):
+            idx = indices[b]
+            next_idx = (idx + n_step) % length
+            out_state_len[b] = min(episode_steps[idx], idx, history_len - 1) + 1
+            out_next_state_len[b] = min(episode_steps[next_idx], next_idx, history_len - 1) + 1
+
+            reward = 0.0
+            done = False
+            for i in range(n_step):
+                step_idx = (idx + i) % length
+                reward += rewards[step_idx] * gamma_pow[i]
+                if dones[step_idx]:
+                    done = True
+                    break
+            out_reward[b] = reward
+            out_done[b] = done
+
+
 class BufferWrapper:
     def __init__(
         self,
@@ -108,9 +243,33 @@ class BufferWrapper:
             mode=self._mode,
             logdir=self._logdir,
         )
+        assert self._data.dtype == self._dtype, f"{self._data.dtype} != {self._dtype}"
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._mode == "shared":
+            # torch.multiprocessing sends the storage as a shared memory handle,
+            # so the other processes read the very same data instead of its copy
+            state["_data"] = (_get_shared_storage(self._data), self._data.shape)
+        elif self._mode == "memmap":
+            # the other processes map the same file instead of getting its copy
+            state["_data"] = (self._data.filename, self._data.shape)
+        return state
+
+    def __setstate__(self, state):
+        if state["_mode"] == "shared":
+            storage, shape = state["_data"]
+            state["_data"] = _get_shared_array(shape, state["_dtype"], storage=storage)
+        elif state["_mode"] == "memmap":
+            filename, shape = state["_data"]
+            state["_data"] = np.memmap(filename, mode="r+", shape=shape, dtype=state["_dtype"])
+        self.__dict__.update(state)
 
     def _as_dtype(self, value):
-        if isinstance(value, np.ndarray) and value.dtype == self._dtype:
+        if isinstance(value, np.ndarray) and (
+            value.dtype == self._dtype or np.dtype(self._dtype).fields is None
+        ):
+            # plain arrays are casted by the assignment itself, no intermediate copy
             value_ = value
         elif isinstance(value, dict) and isinstance(self._dtype, np.dtype):
             value_ = np.zeros(1, dtype=self._dtype)
@@ -128,6 +287,10 @@ class BufferWrapper:
         value_ = self._as_dtype(value)
         self._data[idx] = value_
 
+    @property
+    def data(self):
+        return self._data
+
     @property
     def shape(self):
         return self._data.shape
@@ -176,6 +339,9 @@ class OffpolicyReplayBuffer(Dataset):
                 state in TD backup
             gamma: discount factor
             history_len: number of subsequent observations considered a state
+            mode: storage for the transitions, one of ``numpy``, ``memmap``
+                or ``shared`` (numpy arrays on top of torch shared memory,
+                visible to the DataLoader workers without copies)
         """
         self.epoch_len = epoch_len
         self.observation_space = observation_space
@@ -183,16 +349,24 @@ class OffpolicyReplayBuffer(Dataset):
         self.history_len = history_len
         self.n_step = n_step
         self.gamma = gamma
+        self._gamma_pow = (gamma ** np.arange(n_step)).astype(np.float32)
 
-        self.length = 0
         self.capacity = capacity
         self.capacity_limit_koef = 2
         self.capacity_limit = int(capacity * self.capacity_limit_koef)
 
+        # only the writers take the lock, the readers (e.g. DataLoader workers) use
+        # the shared length snapshot: the new trajectories are stored past it,
+        # but ``recalculate_index`` moves the stored transitions, so it makes the generation
+        # odd for the time of the move (seqlock) and the readers retry when it changed;
+        # the ``numpy`` storage is copied into every process, so are its counters
         self._store_lock = mp.Lock()
+        is_shared = mode in ("shared", "memmap")
+        self._length = _get_counter(is_shared)
+        self._pointer = _get_counter(is_shared)
+        self._generation = _get_counter(is_shared)
         self.num_trajectories = 0
         self.num_transitions = 0
-        self.pointer = 0
         self._trajectories_lens = []
         self._trajectories_rewards = []
 
@@ -221,38 +395,98 @@ class OffpolicyReplayBuffer(Dataset):
         self.dones = BufferWrapper(
             capacity=self.capacity_limit,
             shape=(),
-            dtype=np.bool,
+            dtype=np.bool_,
             name="dones",
             mode=mode,
             logdir=logdir,
         )
+        # number of the previous steps of the same episode for every transition,
+        # so the states are composed without scanning the dones
+        self.episode_steps = BufferWrapper(
+            capacity=self.capacity_limit,
+            shape=(),
+            dtype=np.int64,
+            name="episode_steps",
+            mode=mode,
+            logdir=logdir,
+        )
+        # offsets of the state and the next state frames in the batches,
+        # the frames shared by the overlapping states are sent once
+        self._frames_offsets = np.unique(
+            np.concatenate(
+                (np.arange(-history_len + 1, 1), np.arange(n_step - history_len + 1, n_step + 1))
+            )
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the lock stays with the writer process, the readers never take it
+        state["_store_lock"] = None
+        return state
+
+    @property
+    def length(self) -> int:
+        return self._length.value
+
+    @length.setter
+    def length(self, value: int):
+        self._length.value = value
+
+    @property
+    def pointer(self) -> int:
+        return self._pointer.value
+
+    @pointer.setter
+    def pointer(self, value: int):
+        self._pointer.value = value
 
     def add_trajectory(self, trajectory):
         with self._store_lock:
             observations, actions, rewards, dones = trajectory
             trajectory_len = len(rewards)
-            trajectory_reward = sum(rewards)
+            trajectory_reward = float(np.sum(rewards))
 
-            if self.pointer + trajectory_len >= self.capacity_limit:
+            pointer = self.pointer
+            if pointer + trajectory_len >= self.capacity_limit:
                 return False
 
-            self.observations[self.pointer : self.pointer + trajectory_len] = observations
-            self.actions[self.pointer : self.pointer + trajectory_len] = actions
-            self.rewards[self.pointer : self.pointer + trajectory_len] = rewards
-            self.dones[self.pointer : self.pointer + trajectory_len] = dones
+            self.observations[pointer : pointer + trajectory_len] = observations
+            self.actions[pointer : pointer + trajectory_len] = actions
+            self.rewards[pointer : pointer + trajectory_len] = rewards
+            self.dones[pointer : pointer + trajectory_len] = dones
+            self.episode_steps[pointer : pointer + trajectory_len] = self._get_episode_steps(
+                dones, pointer
+            )
 
             self._trajectories_lens.append(trajectory_len)
             self._trajectories_rewards.append(trajectory_reward)
-            self.pointer += trajectory_len
+            self.pointer = pointer + trajectory_len
             self.num_trajectories += 1
             self.num_transitions += trajectory_len
 
         return True
 
+    def _get_episode_steps(self, dones, pointer):
+        """Number of the previous steps of the same episode for the new transitions"""
+        dones = np.asarray(dones, dtype=np.bool_)
+        positions = np.arange(len(dones))
+        episode_starts = np.zeros(len(dones), dtype=np.bool_)
+        episode_starts[1:] = dones[:-1]
+        episode_starts[0] = pointer == 0 or self.dones[pointer - 1]
+
+        last_starts = np.maximum.accumulate(np.where(episode_starts, positions, -1))
+        episode_steps = positions - last_starts
+        # the trajectory continues the episode stored before it
+        if not episode_starts[0]:
+            episode_steps[last_starts < 0] += self.episode_steps[pointer - 1]
+
+        return episode_steps
+
     def recalculate_index(self):
         with self._store_lock:
             curr_p = self.pointer
             if curr_p > self.capacity:
+                self._generation.value += 1
                 diff = curr_p - self.capacity
 
                 tr_cumsum = np.cumsum(self._trajectories_lens)
@@ -267,65 +501,188 @@ class OffpolicyReplayBuffer(Dataset):
                 curr_p = curr_p - offset
 
                 delta = min(self.capacity // 5, int(1e5))
-                for i in range(0, curr_p, delta):
-                    i_start = i * delta
-                    i_end = min((i + 1) * delta, curr_p)
+                for i_start in range(0, curr_p, delta):
+                    i_end = min(i_start + delta, curr_p)
                     self.observations[i_start:i_end] = self.observations[
                         offset + i_start : offset + i_end
                     ]
                     self.actions[i_start:i_end] = self.actions[offset + i_start : offset + i_end]
                     self.rewards[i_start:i_end] = self.rewards[offset + i_start : offset + i_end]
                     self.dones[i_start:i_end] = self.dones[offset + i_start : offset + i_end]
+                    self.episode_steps[i_start:i_end] = self.episode_steps[
+                        offset + i_start : offset + i_end
+                    ]
 
                 self.pointer = curr_p
-            self.length = curr_p
+                self.length = curr_p
+                self._generation.value += 1
+            else:
+                self.length = curr_p
+
+    def _wait_generation(self) -> int:
+        """Current generation of the stored transitions, waits for the running move"""
+        generation = self._generation.value
+        while generation % 2:
+            time.sleep(1e-3)
+            generation = self._generation.value
+        return generation
+
+    def _read_consistent(self, get_fn: Callable, indices, **kwargs):
+        """
+        Calls ``get_fn`` so that it does not mix the transitions moved by
+        ``recalculate_index``, the indices are re-drawn if the move happened meanwhile
+        """
+        generation = self._wait_generation()
+        while True:
+            # the indices drawn before the move may also point past the moved transitions
+            if np.all(np.asarray(indices) < self.length):
+                output = get_fn(indices, **kwargs)
+                if self._generation.value == generation:
+                    return output
+                generation = self._wait_generation()
+            indices = np.random.randint(
+                0, self.length, size=np.shape(indices) or None, dtype=np.int64
+            )
 
     def _get_state(self, idx, history_len=1):
         """Compose the state from a number (history_len) of observations"""
-        start_idx = idx - history_len + 1
+        num_frames = min(self.episode_steps[idx], idx, history_len - 1) + 1
+        start_idx = idx - num_frames + 1
 
-        if start_idx < 0 or np.any(self.dones[start_idx : idx + 1]):
+        if num_frames < history_len:
             state = np.zeros(
                 (history_len,) + tuple(self.observations.shape[1:]), dtype=self.observations.dtype
             )
-            indices = [idx]
-            for i in range(history_len - 1):
-                next_idx = (idx - i - 1) % self.capacity
-
-                if next_idx >= self.length or self.dones[next_idx]:
-                    break
-                indices.append(next_idx)
-            indices = indices[::-1]
-            state[-len(indices) :] = self.observations[indices]
+            state[-num_frames:] = self.observations[start_idx : idx + 1]
         else:
             state = self.observations[slice(start_idx, idx + 1, 1)]
 
         return state
 
-    def _get_nstep_transition(self, idx, history_len=1, n_step=1, gamma=0.99):
+    def _get_nstep_transition(self, idx, history_len=1):
+        length = self.length
         state = self._get_state(idx, history_len)
-        next_state = self._get_state((idx + n_step) % self.length, history_len)
-        cum_reward = 0
-        indices = np.arange(idx, idx + n_step) % self.length
-        for num, i in enumerate(indices):
-            cum_reward += self.rewards[i] * (gamma ** num)
-            done = self.dones[i]
-            if done:
-                break
+        next_state = self._get_state((idx + self.n_step) % length, history_len)
+
+        end_idx = idx + self.n_step
+        if end_idx <= length:
+            rewards, dones = self.rewards[idx:end_idx], self.dones[idx:end_idx]
+        else:
+            # the n-step window wraps around the buffer end
+            rewards = np.concatenate((self.rewards[idx:length], self.rewards[: end_idx - length]))
+            dones = np.concatenate((self.dones[idx:length], self.dones[: end_idx - length]))
+
+        # the reward is accumulated up to (and including) the first done
+        num_steps = np.argmax(dones) + 1 if dones.any() else self.n_step
+        cum_reward = float(np.dot(rewards[:num_steps], self._gamma_pow[:num_steps]))
+        done = dones[num_steps - 1]
         action = self.actions[idx]
         return state, action, cum_reward, next_state, done
 
+    def _get_num_frames(self, indices, history_len=1):
+        """Number of the episode frames in the states for a batch of indices"""
+        num_frames = np.minimum(self.episode_steps[indices], indices)
+        return np.minimum(num_frames, history_len - 1) + 1
+
+    def _build_nstep_scalars(self, indices, length):
+        """Numba version of the states lengths and the n-step rewards of ``_get_nstep_frames``"""
+        indices = indices.astype(np.int64, copy=False)
+        batch_size = len(indices)
+        state_len = np.empty(batch_size, dtype=np.int64)
+        next_state_len = np.empty(batch_size, dtype=np.int64)
+        rewards = np.empty(batch_size, dtype=np.float32)
+        dones = np.empty(batch_size, dtype=np.bool_)
+        _build_batch(
+            np.asarray(self.rewards.data),
+            np.asarray(self.dones.data),
+            np.asarray(self.episode_steps.data),
+            indices,
+            length,
+            self.history_len,
+            self.n_step,
+            self._gamma_pow,
+            state_len,
+            next_state_len,
+            rewards,
+            dones,
+        )
+        return state_len, next_state_len, rewards, dones
+
+    def _get_nstep_rewards(self, indices, length):
+        step_indices = (indices[:, None] + np.arange(self.n_step)) % length
+        step_dones = self.dones[step_indices]
+        # the reward is accumulated up to (and including) the first done
+        dones = step_dones.any(axis=1)
+        last_steps = np.where(dones, step_dones.argmax(axis=1), self.n_step - 1)
+        rewards_mask = np.arange(self.n_step) <= last_steps[:, None]
+        rewards = (self.rewards[step_indices] * rewards_mask) @ self._gamma_pow
+        return rewards, dones
+
+    def _get_nstep_frames(self, indices):
+        """
+        Frames of the states and the next states for a batch of indices,
+        vectorized version of ``_get_nstep_transition`` without the states masking
+        """
+        length = self.length
+        # the frames out of the buffer are wrapped around, they are masked out anyway;
+        # NumPy fancy indexing copies the whole rows, faster than a compiled gather
+        frames = self.observations[(indices[:, None] + self._frames_offsets) % length]
+        if IS_NUMBA_AVAILABLE:
+            state_len, next_state_len, rewards, dones = self._build_nstep_scalars(indices, length)
+        else:
+            state_len = self._get_num_frames(indices, self.history_len)
+            next_state_len = self._get_num_frames(
+                (indices + self.n_step) % length, self.history_len
+            )
+            rewards, dones = self._get_nstep_rewards(indices, length)
+
+        actions = self.actions[indices]
+        return frames, state_len, next_state_len, actions, rewards, dones
+
+    def sample_batch(self, indices: np.ndarray):
+        """
+        Builds the whole batch of transitions in one go.
+
+        The batch carries the stacked ``frames`` of the states and the next states
+        with the number of their episode frames (``state_len``, ``next_state_len``),
+        ``compose_states`` builds ``state`` and ``next_state`` out of them
+        on the training device.
+        """
+        frames, state_len, next_state_len, actions, rewards, dones = self._read_consistent(
+            self._get_nstep_frames, indices
+        )
+
+        dct = {
+            "frames": _handle_array(frames, keep_bytes=True),
+            "state_len": torch.as_tensor(state_len),
+            "next_state_len": torch.as_tensor(next_state_len),
+            "action": _handle_array(actions),
+            "reward": _handle_array(rewards),
+            "done": _handle_array(dones),
+        }
+
+        return dct
+
     def __getitem__(self, index):
-        state, action, reward, next_state, done = self._get_nstep_transition(
-            index, history_len=self.history_len, n_step=self.n_step, gamma=self.gamma
+        if isinstance(index, np.ndarray):
+            return self.sample_batch(index)
+
+        state, action, reward, next_state, done = self._read_consistent(
+            self._get_nstep_transition, index, history_len=self.history_len
         )
 
+        # the scalars are left to the collate function, it builds one tensor for the whole batch
+        if isinstance(self.action_space, spaces.Discrete):
+            action = int(action)
+        else:
+            action = _handle_array(action)
+
         dct = {
-            "state": _handle_array(state),
-            "action": _handle_array(action),
-            "reward": _handle_array(reward),
-            "next_state": _handle_array(next_state),
-            "done": _handle_array(done),
+            "state": _handle_array(state, keep_bytes=True),
+            "action": action,
+            "reward": float(reward),
+            "next_state": _handle_array(next_state, keep_bytes=True),
+            "done": float(done),
         }
 
         return dct
@@ -341,3 +698,33 @@ class OffpolicyReplayBuffer(Dataset):
 
     def __len__(self):
         return self.epoch_len
+
+
+class ReplayBatchSampler(Sampler):
+    def __init__(self, buffer: OffpolicyReplayBuffer, batch_size: int):
+        """
+        Batch sampler for the ``OffpolicyReplayBuffer``.
+
+        Yields the array of transition indices for the whole batch,
+        so the buffer builds the batch with one ``sample_batch`` call
+        instead of ``batch_size`` ``__getitem__`` calls, the last batch is shorter
+        if the buffer ``epoch_len`` is not divisible by ``batch_size``.
+        Should be used with disabled automatic batching, e.g.
+        ``DataLoader(buffer, batch_size=None, sampler=ReplayBatchSampler(buffer, batch_size))``.
+
+        Args:
+            buffer: replay buffer to sample from
+            batch_size: number of transitions in the batch
+        """
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.num_batches = (buffer.epoch_len + batch_size - 1) // batch_size
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        length = self.buffer.length
+        indices = np.random.randint(0, length, size=self.buffer.epoch_len, dtype=np.int64)
+        for start in range(0, len(indices), self.batch_size):
+            yield indices[start : start + self.batch_size]
+
+    def __len__(self) -> int:
+        return self.num_batches
@@ -2,7 +2,7 @@
 from typing import Optional, Sequence
 import os
 
-from buffer import OffpolicyReplayBuffer
+from buffer import compose_states, OffpolicyReplayBuffer, ReplayBatchSampler
 from db import RedisDB
 import gym
 from misc import GameCallback, soft_update, Trajectory
@@ -41,13 +41,20 @@ class NormalizedActions(gym.ActionWrapper):
 
 
 class Sampler(ISampler):
+    def get_actions(
+        self, network: nn.Module, states: np.array, sigma: Optional[float] = None
+    ) -> np.array:
+        """Actions for the batch of states with one forward pass."""
+        states = torch.as_tensor(states, dtype=torch.float32, device=self.device)
+        actions = network(states).detach().cpu().numpy()
+        if sigma is not None:
+            actions = np.random.normal(actions, sigma)
+        return actions
+
     def get_action(
         self, env, network: nn.Module, state: np.array, sigma: Optional[float] = None
     ) -> np.array:
-        state = torch.tensor(state, dtype=torch.float32).unsqueeze(0)
-        action = network(state).detach().cpu().numpy()[0]
-        if sigma is not None:
-            action = np.random.normal(action, sigma)
+        action = self.get_actions(network, state[None], sigma=sigma)[0]
         return action
 
     def get_trajectory(
@@ -78,7 +85,13 @@ class Sampler(ISampler):
             if done:
                 break
 
-        trajectory = Trajectory(observations, actions, rewards, dones)
+        # stack once here, so the buffer ingests the trajectory with a single copy
+        trajectory = Trajectory(
+            np.array(observations),
+            np.array(actions),
+            np.array(rewards, dtype=np.float32),
+            np.array(dones, dtype=np.bool_),
+        )
         return trajectory
 
 
@@ -125,6 +138,7 @@ class CustomRunner(dl.Runner):
         gamma: float,
         tau: float,
         tau_period: int = 1,
+        history_len: int = 1,
         actor_key: str = "actor",
         critic_key: str = "critic",
         target_actor_key: str = "target_actor",
@@ -137,6 +151,7 @@ class CustomRunner(dl.Runner):
         self.gamma = gamma
         self.tau = tau
         self.tau_period = tau_period
+        self.history_len = history_len
         self.actor_key: str = actor_key
         self.critic_key: str = critic_key
         self.target_actor_key: str = target_actor_key
@@ -170,6 +185,7 @@ class CustomRunner(dl.Runner):
 
     def handle_batch(self, batch: Sequence[torch.Tensor]):
         # model train/valid step
+        batch = compose_states(batch, self.history_len)
         # states, actions, rewards, dones, next_states = batch
         states, actions, rewards, next_states, dones = (
             batch["state"].squeeze_(1).to(torch.float32),
@@ -238,6 +254,7 @@ if __name__ == "__main__":
     gamma = 0.99
     tau = 0.01
     tau_period = 1
+    history_len = 1
     # optimization
     lr_actor = 1e-4
     lr_critic = 1e-3
@@ -256,7 +273,8 @@ if __name__ == "__main__":
         capacity=buffer_size,
         n_step=1,
         gamma=gamma,
-        history_len=1,
+        history_len=history_len,
+        mode="shared",
     )
 
     actor, target_actor = get_network_actor(env), get_network_actor(env)
@@ -277,9 +295,16 @@ if __name__ == "__main__":
         "critic": torch.optim.Adam(critic.parameters(), lr=lr_critic),
     }
 
-    loaders = {"train_game": DataLoader(replay_buffer, batch_size=batch_size)}
+    loaders = {
+        "train_game": DataLoader(
+            replay_buffer,
+            batch_size=None,
+            sampler=ReplayBatchSampler(replay_buffer, batch_size=batch_size),
+            pin_memory=torch.cuda.is_available(),
+        )
+    }
 
-    runner = CustomRunner(gamma=gamma, tau=tau, tau_period=tau_period,)
+    runner = CustomRunner(gamma=gamma, tau=tau, tau_period=tau_period, history_len=history_len,)
 
     runner.train(
         # for simplicity reasons, let's run everything on single gpu
@@ -2,7 +2,7 @@
 from typing import Sequence
 import os
 
-from buffer import OffpolicyReplayBuffer
+from buffer import compose_states, OffpolicyReplayBuffer, ReplayBatchSampler
 from db import RedisDB
 import gym
 from misc import GameCallback, soft_update, Trajectory
@@ -20,13 +20,18 @@ os.environ["MKL_NUM_THREADS"] = "1"
 
 # DQN
 class Sampler(ISampler):
+    def get_actions(self, actor: nn.Module, states: np.array) -> np.array:
+        """Greedy actions for the batch of states with one forward pass."""
+        states = torch.as_tensor(states, dtype=torch.float32, device=self.device)
+        q_values = actor(states).detach()
+        actions = torch.argmax(q_values, dim=-1).cpu().numpy()
+        return actions
+
     def get_action(self, env, actor: nn.Module, state: np.array, epsilon: float = -1) -> int:
         if np.random.random() < epsilon:
             action = env.action_space.sample()
         else:
-            state = torch.tensor(state[None], dtype=torch.float32)
-            q_values = actor(state).detach().cpu().numpy()[0]
-            action = np.argmax(q_values)
+            action = self.get_actions(actor, state[None])[0]
 
         return int(action)
 
@@ -59,7 +64,13 @@ class Sampler(ISampler):
             if done:
                 break
 
-        trajectory = Trajectory(observations, actions, rewards, dones)
+        # stack once here, so the buffer ingests the trajectory with a single copy
+        trajectory = Trajectory(
+            np.array(observations),
+            np.array(actions),
+            np.array(rewards, dtype=np.float32),
+            np.array(dones, dtype=np.bool_),
+        )
         return trajectory
 
 
@@ -91,6 +102,7 @@ class CustomRunner(dl.Runner):
         gamma: float,
         tau: float,
         tau_period: int = 1,
+        history_len: int = 1,
         origin_key: str = "origin",
         target_key: str = "target",
         **kwargs,
@@ -99,6 +111,7 @@ class CustomRunner(dl.Runner):
         self.gamma: float = gamma
         self.tau: float = tau
         self.tau_period: int = tau_period
+        self.history_len: int = history_len
         self.origin_key: str = origin_key
         self.target_key: str = target_key
         self.origin_network: nn.Module = None
@@ -116,6 +129,7 @@ class CustomRunner(dl.Runner):
 
     def handle_batch(self, batch: Sequence[np.array]):
         # model train/valid step
+        batch = compose_states(batch, self.history_len)
         states, actions, rewards, next_states, dones = (
             batch["state"].squeeze_(1).to(torch.float32),
             batch["action"].to(torch.int64),
@@ -173,6 +187,7 @@ if __name__ == "__main__":
     gamma = 0.99
     tau = 0.01
     tau_period = 1  # in batches
+    history_len = 1
     # optimization
     lr = 3e-4
 
@@ -190,7 +205,8 @@ if __name__ == "__main__":
         capacity=buffer_size,
         n_step=1,
         gamma=gamma,
-        history_len=1,
+        history_len=history_len,
+        mode="shared",
     )
 
     network, target_network = get_network(env), get_network(env)
@@ -198,9 +214,16 @@ if __name__ == "__main__":
     models = {"origin": network, "target": target_network}
     criterion = torch.nn.MSELoss()
     optimizer = torch.optim.Adam(network.parameters(), lr=lr)
-    loaders = {"train_game": DataLoader(replay_buffer, batch_size=batch_size)}
+    loaders = {
+        "train_game": DataLoader(
+            replay_buffer,
+            batch_size=None,
+            sampler=ReplayBatchSampler(replay_buffer, batch_size=batch_size),
+            pin_memory=torch.cuda.is_available(),
+        )
+    }
 
-    runner = CustomRunner(gamma=gamma, tau=tau, tau_period=tau_period)
+    runner = CustomRunner(gamma=gamma, tau=tau, tau_period=tau_period, history_len=history_len)
     runner.train(
         # for simplicity reasons, let's run everything on single gpu
         engine=dl.DeviceEngine("cuda"),
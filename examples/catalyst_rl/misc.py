@@ -2,11 +2,11 @@
 from typing import Callable, Dict, TYPE_CHECKING
 from collections import namedtuple
 import copy
-import multiprocessing as mp
 import threading
 import time
 
 import numpy as np
+import torch.multiprocessing as mp
 import torch.nn as nn
 
 from catalyst import dl
@@ -175,6 +175,7 @@ class GameCallback(dl.Callback):
                     weights_key=self.actor_key,
                     weights_sync_period=10,
                     device="cpu",
+                    seed=runner.seed,
                 ),
                 daemon=True,
             )
@@ -24,6 +24,7 @@ class ISampler(ABC):
         weights_key: str,
         weights_sync_period: int,
         device=None,
+        seed: int = 42,
     ):
         self.env = env
         self.actor = actor
@@ -34,6 +35,12 @@ class ISampler(ABC):
         self.device = device or "cpu"
         self.trajectory_index = 0
 
+        # samplers are forked from the same process,
+        # so each of them needs its own random stream for the exploration
+        self.seed = seed + sampler_index
+        utils.set_global_seed(self.seed)
+        self.env.seed(self.seed)
+
     @abstractmethod
     def get_trajectory(
         self,
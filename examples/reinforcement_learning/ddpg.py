@@ -31,7 +31,7 @@ class ReplayBuffer:
         states = np.array(states, dtype=np.float32)
         actions = np.array(actions, dtype=np.int64)
         rewards = np.array(rewards, dtype=np.float32)
-        dones = np.array(dones, dtype=np.bool)
+        dones = np.array(dones, dtype=np.bool_)
         next_states = np.array(next_states, dtype=np.float32)
         return states, actions, rewards, dones, next_states
 
@@ -87,7 +87,7 @@ class NormalizedActions(gym.ActionWrapper):
 def get_action(
     env, network: nn.Module, state: np.array, sigma: Optional[float] = None
 ) -> np.array:
-    state = torch.tensor(state, dtype=torch.float32).unsqueeze(0)
+    state = torch.as_tensor(state[None], dtype=torch.float32)
     action = network(state).detach().cpu().numpy()[0]
     if sigma is not None:
         action = np.random.normal(action, sigma)
@@ -31,7 +31,7 @@ class ReplayBuffer:
         states = np.array(states, dtype=np.float32)
         actions = np.array(actions, dtype=np.int64)
         rewards = np.array(rewards, dtype=np.float32)
-        dones = np.array(dones, dtype=np.bool)
+        dones = np.array(dones, dtype=np.bool_)
         next_states = np.array(next_states, dtype=np.float32)
         return states, actions, rewards, dones, next_states
 
@@ -68,9 +68,9 @@ def get_action(env, network: nn.Module, state: np.array, epsilon: float = -1) ->
     if np.random.random() < epsilon:
         action = env.action_space.sample()
     else:
-        state = torch.tensor(state[None], dtype=torch.float32)
-        q_values = network(state).detach().cpu().numpy()[0]
-        action = np.argmax(q_values)
+        state = torch.as_tensor(state[None], dtype=torch.float32)
+        q_values = network(state).detach()[0]
+        action = torch.argmax(q_values).item()
 
     return int(action)
 
@@ -62,17 +62,8 @@ def get_cumulative_rewards(rewards, gamma=0.99):
     return G
 
 
-def to_one_hot(y, n_dims=None):
-    """ Takes an integer vector and converts it to 1-hot matrix. """
-    y_tensor = y
-    y_tensor = y_tensor.type(torch.LongTensor).view(-1, 1)
-    n_dims = n_dims if n_dims is not None else int(torch.max(y_tensor)) + 1
-    y_one_hot = torch.zeros(y_tensor.size()[0], n_dims).scatter_(1, y_tensor, 1)
-    return y_one_hot
-
-
 def get_action(env, network: nn.Module, state: np.array) -> int:
-    state = torch.tensor(state[None], dtype=torch.float32)
+    state = torch.as_tensor(state[None], dtype=torch.float32)
     logits = network(state).detach()
     probas = F.softmax(logits, -1).cpu().numpy()[0]
     action = np.random.choice(len(probas), p=probas)
@@ -211,8 +202,7 @@ class CustomRunner(dl.Runner):
         logits = self.model(states)
         probas = F.softmax(logits, -1)
         logprobas = F.log_softmax(logits, -1)
-        n_actions = probas.shape[1]
-        logprobas_for_actions = torch.sum(logprobas * to_one_hot(actions, n_dims=n_actions), dim=1)
+        logprobas_for_actions = logprobas.gather(1, actions.unsqueeze(-1)).squeeze(-1)
 
         J_hat = torch.mean(logprobas_for_actions * cumulative_returns)
         entropy_reg = -torch.mean(torch.sum(probas * logprobas, dim=1))